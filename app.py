@@ -3,23 +3,40 @@
 import os
 import io
 import json
+import re
 import sqlite3
+import numpy as np
 import pandas as pd
 import streamlit as st
 from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
+from openpyxl import Workbook
 
 load_dotenv()
 
 DB_PATH = "incidencias.db"
 SEEDS_PATH = "seeds/plants.json"
 DEFAULT_TYPES = ["FALTA", "RETARDO", "PERMISO", "INCAPACIDAD", "OTRO"]
+EXPORT_CHUNK = 50_000  # filas por bloque al exportar a Excel
 
 # ------------------------------
 # DB helpers
 # ------------------------------
-def get_conn():
+def _connect():
+    # check_same_thread=False: los reruns de una sesión pueden caer en otro hilo
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # WAL: lecturas no bloquean escrituras; NORMAL: menos fsync por commit
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")  # 64 MB
+    conn.execute("PRAGMA mmap_size=268435456;")
+    return conn
+
+@st.cache_resource
+def _init_db():
+    """Esquema, índices y plantas semilla: una vez por proceso, no en cada rerun."""
+    conn = _connect()
     # plants
     conn.execute("""
         CREATE TABLE IF NOT EXISTS plants(
@@ -48,10 +65,33 @@ def get_conn():
             plant TEXT NOT NULL,
             inc_type TEXT NOT NULL,
             hours REAL,
-            notes TEXT
+            notes TEXT,
+            dt_ord INTEGER
         );
     """)
-    return conn
+    ensure_company_column(conn)
+    ensure_dt_ord_column(conn)
+    # Filtros por fecha sobre dt_ord (entero); dt queda como texto para mostrar
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inc_ord ON incidences(dt_ord, employee);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inc_plant_ord ON incidences(plant, dt_ord);")
+    seed_plants(conn)
+    conn.close()
+    return True
+
+def get_conn():
+    """
+    Una conexión por sesión: cada sesión de Streamlit corre en su propio hilo, y una
+    conexión compartida mezclaría sus transacciones (BEGIN anidado, commit/rollback ajeno).
+    """
+    _init_db()
+    if "conn" not in st.session_state:
+        st.session_state["conn"] = _connect()
+    return st.session_state["conn"]
+
+def _db_ver():
+    """mtime de la base y de su WAL: cambia con cada escritura, sirve como llave de caché."""
+    return tuple(os.stat(p).st_mtime_ns if os.path.exists(p) else 0
+                 for p in (DB_PATH, DB_PATH + "-wal"))
 
 def ensure_company_column(conn):
     cols = {r[1].lower() for r in conn.execute("PRAGMA table_info(employees);").fetchall()}
@@ -59,11 +99,27 @@ def ensure_company_column(conn):
         conn.execute("ALTER TABLE employees ADD COLUMN company TEXT;")
         conn.commit()
 
+def ensure_dt_ord_column(conn):
+    """dt_ord = date.toordinal() del día de dt; se rellena para filas anteriores a la columna."""
+    cols = {r[1].lower() for r in conn.execute("PRAGMA table_info(incidences);").fetchall()}
+    if "dt_ord" not in cols:
+        conn.execute("ALTER TABLE incidences ADD COLUMN dt_ord INTEGER;")
+    # julianday('0001-01-01') = 1721425.5 y date(1,1,1).toordinal() = 1
+    conn.execute("""
+        UPDATE incidences SET dt_ord = CAST(julianday(SUBSTR(dt,1,10)) - 1721424.5 AS INTEGER)
+        WHERE dt_ord IS NULL;
+    """)
+    conn.commit()
+
 # === ZONAS (usamos la columna plant como "zona" en UI) ===
-def get_zonas(conn):
-    return [r[0] for r in conn.execute(
-        "SELECT DISTINCT plant FROM employees WHERE plant IS NOT NULL AND plant<>'' ORDER BY 1;"
-    ).fetchall()]
+@st.cache_data(ttl=300, max_entries=4, show_spinner=False)
+def _employee_facets(db_ver):
+    """(zonas, empresas, nombres) de employees en una sola lectura; se invalida con db_ver."""
+    df = pd.read_sql_query(
+        "SELECT name, plant, COALESCE(company,'') AS company FROM employees;", get_conn())
+    return (sorted(p for p in df["plant"].dropna().unique() if p),
+            sorted(c for c in df["company"].unique() if c),
+            sorted(df["name"].unique()))
 
 # === Mapa de colores para incidencias ===
 INC_COLOR = {
@@ -78,38 +134,38 @@ INC_COLOR = {
 
 
 def seed_plants(conn):
-    cur = conn.execute("SELECT COUNT(*) FROM plants;")
-    count = cur.fetchone()[0]
-    if count == 0 and os.path.exists(SEEDS_PATH):
+    empty = conn.execute("SELECT 1 FROM plants LIMIT 1;").fetchone() is None
+    if empty and os.path.exists(SEEDS_PATH):
         with open(SEEDS_PATH, "r", encoding="utf-8") as f:
             names = json.load(f)
-        for n in names:
-            try:
-                conn.execute("INSERT INTO plants(name) VALUES(?)", (n.strip().upper(),))
-            except sqlite3.IntegrityError:
-                pass
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR IGNORE INTO plants(name) VALUES(?)",
+                         ((n.strip().upper(),) for n in names))
         conn.commit()
 
-def get_plants(conn):
-    cur = conn.execute("SELECT name FROM plants ORDER BY name;")
+@st.cache_data(ttl=300)
+def get_plants(_conn):
+    cur = _conn.execute("SELECT name FROM plants ORDER BY name;")
     return [r[0] for r in cur.fetchall()]
 
 def add_plant(conn, name):
     conn.execute("INSERT OR IGNORE INTO plants(name) VALUES(?)", (name.strip().upper(),))
     conn.commit()
+    get_plants.clear()
 
 # --- employees
 def seed_employees(conn, rows):
-    """UPSERT por name (no duplica, actualiza)."""
-    for r in rows:
-        name = r["name"].strip().upper()
-        plant = r["plant"].strip().upper()
-        hire  = r["hire_date"]
-        dpy   = int(r.get("days_per_year", 12))
-        rest  = (r.get("rest_day") or "").strip().upper() or None
-        comp  = (r.get("company") or "").strip().upper() or None
-
-        conn.execute("""
+    """UPSERT por name (no duplica, actualiza) en una sola transacción."""
+    tuples = [(r["name"].strip().upper(),
+               r["plant"].strip().upper(),
+               r["hire_date"],
+               int(r.get("days_per_year", 12) or 12),
+               (r.get("rest_day") or "").strip().upper() or None,
+               (r.get("company") or "").strip().upper() or None)
+              for r in rows]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("""
             INSERT INTO employees (name, plant, hire_date, days_per_year, rest_day, company)
             VALUES (?, ?, ?, ?, ?, ?)
             ON CONFLICT(name) DO UPDATE SET
@@ -118,8 +174,11 @@ def seed_employees(conn, rows):
                days_per_year=excluded.days_per_year,
                rest_day=excluded.rest_day,
                company=excluded.company
-        """, (name, plant, hire, dpy, rest, comp))
-    conn.commit()
+        """, tuples)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 def get_employees_df(conn, plant=None, company=None):
     q = "SELECT name, plant, rest_day, COALESCE(company,'') AS company FROM employees WHERE 1=1"
@@ -131,15 +190,6 @@ def get_employees_df(conn, plant=None, company=None):
     q += " ORDER BY name;"
     return pd.read_sql_query(q, conn, params=p)
 
-def get_employees(conn, plant=None, company=None):
-    df = get_employees_df(conn, plant, company)
-    return df["name"].tolist()
-
-def get_companies(conn):
-    return [r[0] for r in conn.execute(
-        "SELECT DISTINCT COALESCE(company,'') FROM employees ORDER BY 1;"
-    ).fetchall() if r[0]]
-
 def get_employee_info(conn, name):
     cur = conn.execute(
         "SELECT name, plant, hire_date, days_per_year, rest_day, company FROM employees WHERE name=?",
@@ -149,76 +199,190 @@ def get_employee_info(conn, name):
     return {"name": r[0], "plant": r[1], "hire_date": r[2], "days_per_year": r[3], "rest_day": r[4], "company": r[5]}
 
 # --- incidences
+def _ord(dt_iso):
+    """'YYYY-MM-DD...' (o date) -> número de día (date.toordinal), el valor de dt_ord."""
+    return date.fromisoformat(str(dt_iso)[:10]).toordinal()
+
 def insert_incidence(conn, dt, employee, plant, inc_type, notes=""):
     """Inserta una incidencia (sin horas)."""
     conn.execute(
-        "INSERT INTO incidences(dt, employee, plant, inc_type, hours, notes) VALUES(?,?,?,?,?,?)",
-        (dt, employee.strip(), plant.strip().upper(), inc_type.strip().upper(), None, notes.strip() if notes else None)
+        "INSERT INTO incidences(dt, employee, plant, inc_type, hours, notes, dt_ord) VALUES(?,?,?,?,?,?,?)",
+        (dt, employee.strip(), plant.strip().upper(), inc_type.strip().upper(), None, notes.strip() if notes else None,
+         _ord(dt))
     )
     conn.commit()
 
-def replace_incidence_day(conn, dt_iso, employee, inc_type, notes=""):
-    """Borra lo que haya ese día para el empleado y vuelve a grabar si inc_type no está vacío."""
-    conn.execute("DELETE FROM incidences WHERE employee=? AND DATE(dt)=DATE(?)",
-                 (employee, dt_iso))
-    if inc_type and inc_type != "—":
-        plant = get_employee_info(conn, employee)["plant"]
-        insert_incidence(conn, dt_iso, employee, plant, inc_type, notes)
-    conn.commit()
+def replace_incidences_bulk(conn, cells, plant_map=None):
+    """
+    Reemplaza celdas de la matriz semanal: borra lo que haya ese día para el empleado y
+    vuelve a grabar si inc_type no está vacío.
+    cells = [(dt_iso, employee, inc_type), ...]; todo en una sola transacción.
+    plant_map = {employee: plant}; si no se pasa se lee de employees una sola vez.
+    """
+    if plant_map is None:
+        plant_map = dict(conn.execute("SELECT name, plant FROM employees;").fetchall())
+    pairs = [(emp, _ord(iso)) for iso, emp, _ in cells]
+    inserts = [(iso, emp, plant_map[emp], t, _ord(iso))
+               for iso, emp, t in cells
+               if t and t != "—" and emp in plant_map]
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("DELETE FROM incidences WHERE employee=? AND dt_ord=?", pairs)
+        conn.executemany(
+            "INSERT INTO incidences(dt, employee, plant, inc_type, hours, notes, dt_ord)"
+            " VALUES(?,?,?,?,NULL,NULL,?)",
+            inserts)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(inserts)
 
-def read_incidents_df(conn, start_dt=None, end_dt=None, plant=None, company=None):
+def _incidents_where(start_dt=None, end_dt=None, plant=None, company=None):
+    """FROM/WHERE común para el detalle y el resumen de incidencias."""
     base = """
-      SELECT i.dt, i.employee, i.plant, i.inc_type, COALESCE(e.company,'') AS company, i.notes
       FROM incidences i
       LEFT JOIN employees e ON e.name = i.employee
       WHERE 1=1
     """
     params = []
     if start_dt:
-        base += " AND DATE(i.dt) >= DATE(?)"; params.append(start_dt)
+        base += " AND i.dt_ord >= ?"; params.append(_ord(start_dt))
     if end_dt:
-        base += " AND DATE(i.dt) <= DATE(?)"; params.append(end_dt)
+        base += " AND i.dt_ord <= ?"; params.append(_ord(end_dt))
     if plant and plant != "TODAS":
         base += " AND i.plant = ?"; params.append(plant)
     if company and company != "TODAS":
         base += " AND COALESCE(e.company,'') = ?"; params.append(company)
-    base += " ORDER BY DATE(i.dt) DESC, i.plant, i.employee;"
-    return pd.read_sql_query(base, conn, params=params)
+    return base, params
+
+def _incidents_query(start_dt=None, end_dt=None, plant=None, company=None, limit=None):
+    where, params = _incidents_where(start_dt, end_dt, plant, company)
+    base = """
+      SELECT i.dt, i.employee, i.plant, i.inc_type, COALESCE(e.company,'') AS company, i.notes
+    """ + where + " ORDER BY i.dt_ord DESC, i.plant, i.employee"
+    if limit:
+        base += " LIMIT ?"; params.append(limit)
+    return base + ";", params
+
+def _to_date(s):
+    """Texto 'YYYY-MM-DD...' -> datetime.date (celda de fecha en Excel, sin inferir por celda)."""
+    return pd.to_datetime(s.astype(str).str[:10], format="%Y-%m-%d", errors="coerce").dt.date
+
+def read_incidents_df(conn, start_dt=None, end_dt=None, plant=None, company=None, limit=None):
+    base, params = _incidents_query(start_dt, end_dt, plant, company, limit)
+    # Columnas Arrow (string[pyarrow]): menos memoria y sin conversión al mostrar en st.dataframe
+    df = pd.read_sql_query(base, conn, params=params, dtype_backend="pyarrow")
+    df["dt"] = _to_date(df["dt"])
+    # Pocas plantas y tipos: como category, filtros y agrupaciones trabajan sobre códigos
+    df[["plant", "inc_type"]] = df[["plant", "inc_type"]].astype("category")
+    return df
+
+def read_consolidado(conn, start_dt=None, end_dt=None, plant=None, company=None):
+    """
+    Detalle y resumen (empresa, planta, tipo) en una sola sentencia: el CTE filtra una vez
+    y se lee dos veces (SQLite materializa un CTE usado más de una vez).
+    """
+    where, params = _incidents_where(start_dt, end_dt, plant, company)
+    q = """
+      WITH flt AS (
+        SELECT i.dt, i.dt_ord, i.employee, i.plant, i.inc_type,
+               COALESCE(e.company,'') AS company, i.notes
+    """ + where + """
+      )
+      SELECT 0 AS part, dt, dt_ord, employee, plant, inc_type, company, notes, NULL AS n FROM flt
+      UNION ALL
+      SELECT 1, NULL, NULL, NULL, plant, inc_type, company, NULL, COUNT(*)
+      FROM flt GROUP BY company, plant, inc_type
+      ORDER BY 1, 3 DESC, 5, 4;
+    """
+    res = pd.read_sql_query(q, conn, params=params, dtype_backend="pyarrow")
+    df = res.loc[res["part"] == 0, ["dt", "employee", "plant", "inc_type", "company", "notes"]]
+    df = df.assign(dt=_to_date(df["dt"]))
+    summary = (res.loc[res["part"] == 1, ["company", "plant", "inc_type", "n"]]
+               .rename(columns={"n": "Incidencias"})
+               .sort_values(["company", "plant", "inc_type"]))
+    return df.reset_index(drop=True), summary.reset_index(drop=True)
+
+def iter_incidents_chunks(conn, start_dt=None, end_dt=None, plant=None, company=None, chunksize=None):
+    """Mismo resultado que read_incidents_df, en bloques de `chunksize` filas (para exportar)."""
+    base, params = _incidents_query(start_dt, end_dt, plant, company)
+    cur = conn.execute(base, params)
+    cols = [d[0] for d in cur.description]
+    while True:
+        rows = cur.fetchmany(chunksize or EXPORT_CHUNK)
+        if not rows:
+            break
+        chunk = pd.DataFrame.from_records(rows, columns=cols)
+        chunk["dt"] = _to_date(chunk["dt"])
+        yield chunk
+
+@st.cache_data(ttl=60, max_entries=32, show_spinner=False)
+def read_incidents_df_cached(db_ver, start_dt=None, end_dt=None, plant=None, company=None, limit=None):
+    return read_incidents_df(get_conn(), start_dt, end_dt, plant, company, limit)
+
+@st.cache_data(ttl=60, max_entries=32, show_spinner=False)
+def read_consolidado_cached(db_ver, start_dt=None, end_dt=None, plant=None, company=None):
+    return read_consolidado(get_conn(), start_dt, end_dt, plant, company)
+
+EXPORT_COLUMNS = {"dt": "Fecha", "employee": "Empleado", "plant": "Planta",
+                  "inc_type": "Tipo", "notes": "Observaciones", "company": "Empresa"}
+
+def _excel_rows(df):
+    """Filas listas para ws.append: dt llega como datetime.date (celda de fecha) y NaN/NA como celda vacía."""
+    for start in range(0, len(df), EXPORT_CHUNK):
+        part = df.iloc[start:start + EXPORT_CHUNK]
+        yield from part.to_numpy(dtype=object, na_value=None).tolist()
 
 def to_excel_bytes(df_data, df_summary):
+    """
+    Escribe en modo write_only: las filas se emiten en streaming, sin guardar celdas en memoria.
+    df_data puede ser un DataFrame o un iterable de DataFrames (p. ej. iter_incidents_chunks).
+    """
+    wb = Workbook(write_only=True)
+    for title, chunks in (("Datos", df_data), ("Resumen", df_summary)):
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        ws = wb.create_sheet(title)
+        header = False
+        for df in chunks:
+            if not header:
+                ws.append(list(df.columns))
+                header = True
+            for row in _excel_rows(df):
+                ws.append(row)
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df_data.to_excel(writer, sheet_name="Datos", index=False)
-        df_summary.to_excel(writer, sheet_name="Resumen", index=False)
-    output.seek(0)
+    wb.save(output)
     return output.getvalue()
 
+@st.cache_data(max_entries=4, show_spinner="Generando Excel...")
+def consolidado_excel_bytes(db_ver, start_dt, end_dt, plant, company):
+    """Excel del consolidado (Datos + Resumen) para un juego de filtros."""
+    summary = read_consolidado_cached(db_ver, start_dt, end_dt, plant, company)[1]
+    return to_excel_bytes(
+        (chunk.rename(columns=EXPORT_COLUMNS)
+         for chunk in iter_incidents_chunks(get_conn(), start_dt, end_dt, plant, company)),
+        summary.rename(columns=EXPORT_COLUMNS)
+    )
+
 # ------------------------------
 # CSV Maestro transform
 # ------------------------------
-import re
+ACCENT_TBL = str.maketrans("ÁÉÍÓÚ", "AEIOU")
+_DIGITS_RE = re.compile(r"(\d+)")
+_SPACES_RE = re.compile(r"\s+")
+_REST_MAP = {
+    "LUNES":"LUN","MARTES":"MAR","MIERCOLES":"MIE",
+    "JUEVES":"JUE","VIERNES":"VIE","SABADO":"SAB","DOMINGO":"DOM",
+    "LUN":"LUN","MAR":"MAR","MIE":"MIE","JUE":"JUE","VIE":"VIE","SAB":"SAB","DOM":"DOM"
+}
 
-def _normalize_rest_day(raw: str) -> str:
-    if not raw:
-        return ""
-    s = str(raw).strip().upper()
-    s = (s.replace("Á","A").replace("É","E").replace("Í","I")
-           .replace("Ó","O").replace("Ú","U"))
-    mapa = {
-        "LUNES":"LUN","MARTES":"MAR","MIERCOLES":"MIE","MIÉRCOLES":"MIE",
-        "JUEVES":"JUE","VIERNES":"VIE","SABADO":"SAB","SÁBADO":"SAB","DOMINGO":"DOM",
-        "LUN":"LUN","MAR":"MAR","MIE":"MIE","JUE":"JUE","VIE":"VIE","SAB":"SAB","DOM":"DOM"
-    }
-    return mapa.get(s, "")
-
-def _parse_ddmmyyyy(s: str) -> str:
-    if not s: return ""
-    s = str(s).strip().replace("-", "/")
-    try:
-        dt = datetime.strptime(s, "%d/%m/%Y")
-        return dt.date().isoformat()
-    except Exception:
-        return ""
+def _upper_or_none(df, name):
+    """Columna opcional en mayúsculas y sin espacios; vacíos/NaN (o columna ausente) -> None."""
+    if name not in df.columns:
+        return None
+    s = df[name].fillna("").astype(str).str.upper().str.strip()
+    return s.where(s != "", None)
 
 def transform_employees_csv(df):
     """
@@ -233,41 +397,36 @@ def transform_employees_csv(df):
     if missing:
         raise ValueError(f"Faltan columnas en el CSV: {', '.join(missing)}")
 
-    out = []
-    for _, r in df.iterrows():
-        company = str(r[cols["EMPRESA"]]).strip().upper()
-        plant   = str(r[cols["ZONA"]]).strip().upper()
-        nombre  = str(r[cols["NOMBRE"]]).strip()
-        paterno = str(r[cols["PATERNO"]]).strip()
-        materno = str(r[cols["MATERNO"]]).strip()
-        full_name = " ".join([nombre, paterno, materno]).upper().replace("  ", " ").strip()
-
-        hire_iso = _parse_ddmmyyyy(r[cols["INGRESO"]])
-        rest_day = _normalize_rest_day(r[cols["DIA DE DESCANSO"]])
-        try:
-            dpy = int(re.sub(r"[^0-9]", "", str(r[cols["DIAS CORRESPONDIENTES"]])))
-            if dpy <= 0: dpy = 12
-        except Exception:
-            dpy = 12
-
-        if not full_name or not plant or not hire_iso:
-            continue
-
-        out.append({
-            "name": full_name,
-            "plant": plant,
-            "hire_date": hire_iso,
-            "days_per_year": dpy,
-            "rest_day": rest_day or None,
-            "company": company
-        })
-    return out
+    def col(name):
+        return df[cols[name]].fillna("").astype(str).str.strip()
+
+    full_name = (col("NOMBRE") + " " + col("PATERNO") + " " + col("MATERNO")) \
+        .str.replace(_SPACES_RE, " ", regex=True).str.strip().str.upper()
+    hire = pd.to_datetime(col("INGRESO").str.replace("-", "/"), format="%d/%m/%Y", errors="coerce")
+    dpy = pd.to_numeric(col("DIAS CORRESPONDIENTES").str.extract(_DIGITS_RE, expand=False),
+                        errors="coerce").fillna(0).astype(int)
+
+    out = pd.DataFrame({
+        "name": full_name,
+        "plant": col("ZONA").str.upper(),
+        "hire_date": hire.dt.strftime("%Y-%m-%d"),
+        "days_per_year": dpy.where(dpy > 0, 12),
+        "rest_day": col("DIA DE DESCANSO").str.upper().str.translate(ACCENT_TBL)
+                    .map(_REST_MAP).astype(object).where(lambda x: x.notna(), None),
+        "company": col("EMPRESA").str.upper(),
+    })
+    out = out[(out["name"] != "") & (out["plant"] != "")].dropna(subset=["hire_date"])
+    return out.to_dict(orient="records")
 
 # ------------------------------
 # Vacations helpers
 # ------------------------------
-def months_between(d1, d2):
-    return (d2.year - d1.year)*12 + (d2.month - d1.month) - (0 if d2.day >= d1.day else 1)
+def months_between_arr(starts, end):
+    """Meses completos de cada fecha de una Series datetime64 a una fecha fija (arreglo NumPy, mínimo 0)."""
+    y = starts.dt.year.to_numpy()
+    mo = starts.dt.month.to_numpy()
+    d = starts.dt.day.to_numpy()
+    return np.maximum((end.year - y)*12 + (end.month - mo) - (end.day < d), 0)
 
 def current_year_period():
     today = date.today()
@@ -277,57 +436,64 @@ def prev_year_period():
     today = date.today()
     return date(today.year-1,1,1), date(today.year-1,12,31)
 
-def get_vacations_taken(conn, name, start, end):
-    """Cuenta 1 por cada registro de VACACIONES en el periodo."""
-    df = pd.read_sql_query("""
-        SELECT dt FROM incidences
-        WHERE employee=? AND inc_type='VACACIONES'
-          AND DATE(dt) BETWEEN DATE(?) AND DATE(?)
-    """, conn, params=(name, start.isoformat(), end.isoformat()))
-    return float(len(df))
-
 def vacation_status_for_all(conn):
     today = date.today()
     cy_start, cy_end = current_year_period()
     py_start, py_end = prev_year_period()
 
-    cur = conn.execute("SELECT name, plant, hire_date, days_per_year FROM employees ORDER BY plant, name;")
-    out = []
-    for name, plant, hire, dpy in cur.fetchall():
-        try:
-            hd = datetime.fromisoformat(hire).date()
-        except Exception:
-            continue
-        start_for_months = max(hd, cy_start)
-        m = max(0, months_between(start_for_months, today))
-        entitlement_cy = round((dpy/12.0)*min(m,12), 2)
-        taken_cy = get_vacations_taken(conn, name, cy_start, cy_end)
-        remaining_cy = round(entitlement_cy - taken_cy, 2)
-
-        entitlement_py = 0.0
-        if hd <= py_end:
-            start_for_py = max(hd, py_start)
-            m_py = max(0, months_between(start_for_py, py_end))
-            entitlement_py = round((dpy/12.0)*min(m_py,12), 2)
-        taken_py = get_vacations_taken(conn, name, py_start, py_end)
-        remaining_py = round(entitlement_py - taken_py, 2)
-
-        expiry_date = py_end + timedelta(days=365)
-        days_to_expiry = (expiry_date - today).days
-        will_expire = remaining_py > 0 and days_to_expiry <= 60
-
-        out.append({
-            "Empleado": name, "Planta": plant, "Ingreso": hd.isoformat(),
-            "Dias/Año": dpy, "Meses trabajados (año)": m,
-            "Derecho año actual": entitlement_cy,
-            "Tomado año actual": taken_cy,
-            "Saldo año actual": remaining_cy,
-            "Saldo año anterior": remaining_py,
-            "Vence saldo anterior": expiry_date.isoformat(),
-            "Días para vencer": days_to_expiry,
-            "ALERTA": "⚠️" if will_expire else ""
-        })
-    return pd.DataFrame(out)
+    df = pd.read_sql_query(
+        "SELECT name, plant, hire_date, days_per_year FROM employees ORDER BY plant, name;", conn)
+    df["hd"] = pd.to_datetime(df["hire_date"], format="ISO8601", errors="coerce")
+    df = df.dropna(subset=["hd"])
+    cols = ["Empleado", "Planta", "Ingreso", "Dias/Año", "Meses trabajados (año)",
+            "Derecho año actual", "Tomado año actual", "Saldo año actual", "Saldo año anterior",
+            "Vence saldo anterior", "Días para vencer", "ALERTA"]
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+
+    # Una sola consulta: vacaciones tomadas por empleado y año (actual y anterior)
+    vac = pd.read_sql_query("""
+        SELECT employee, SUBSTR(dt,1,4) AS yr, COUNT(*) AS n
+        FROM incidences
+        WHERE inc_type='VACACIONES' AND dt_ord BETWEEN ? AND ?
+        GROUP BY employee, yr
+    """, conn, params=(py_start.toordinal(), cy_end.toordinal()))
+    taken = vac.pivot_table(index="employee", columns="yr", values="n", aggfunc="sum")
+    taken = taken.reindex(columns=[str(cy_start.year), str(py_start.year)]).fillna(0.0)
+    df = df.merge(taken, left_on="name", right_index=True, how="left")
+    taken_cy = df[str(cy_start.year)].fillna(0.0).astype(float)
+    taken_py = df[str(py_start.year)].fillna(0.0).astype(float)
+
+    dpy = df["days_per_year"].astype(float)
+
+    m = months_between_arr(df["hd"].clip(lower=pd.Timestamp(cy_start)), today)
+    entitlement_cy = ((dpy/12.0)*np.minimum(m, 12)).round(2)
+
+    m_py = months_between_arr(df["hd"].clip(lower=pd.Timestamp(py_start)), py_end)
+    entitlement_py = ((dpy/12.0)*np.minimum(m_py, 12)).round(2) \
+        .where(df["hd"] <= pd.Timestamp(py_end), 0.0)
+    remaining_py = (entitlement_py - taken_py).round(2)
+
+    expiry_date = py_end + timedelta(days=365)
+    days_to_expiry = (expiry_date - today).days
+    will_expire = (remaining_py > 0) & (days_to_expiry <= 60)
+
+    out = pd.DataFrame({
+        "Empleado": df["name"], "Planta": df["plant"], "Ingreso": df["hd"].dt.strftime("%Y-%m-%d"),
+        "Dias/Año": df["days_per_year"], "Meses trabajados (año)": m,
+        "Derecho año actual": entitlement_cy,
+        "Tomado año actual": taken_cy,
+        "Saldo año actual": (entitlement_cy - taken_cy).round(2),
+        "Saldo año anterior": remaining_py,
+        "Vence saldo anterior": expiry_date.isoformat(),
+        "Días para vencer": days_to_expiry,
+        "ALERTA": will_expire.map({True: "⚠️", False: ""})
+    }, columns=cols)
+    return out.reset_index(drop=True)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def vacation_status_for_all_cached(db_ver):
+    return vacation_status_for_all(get_conn())
 
 # ------------------------------
 # UI
@@ -335,8 +501,12 @@ def vacation_status_for_all(conn):
 st.set_page_config(page_title="Incidencias Semanales", page_icon="🗂️", layout="wide")
 
 conn = get_conn()
-seed_plants(conn)
-ensure_company_column(conn)
+
+# Lista de plantas en la sesión; se refresca solo si la BD cambió (p. ej. tras add_plant)
+if st.session_state.get("plants_ver") != _db_ver():
+    st.session_state["plants"] = get_plants(conn)
+    st.session_state["plants_ver"] = _db_ver()
+plants = st.session_state["plants"]
 
 # Sidebar
 st.sidebar.title("🛠️ Configuración")
@@ -379,8 +549,7 @@ if section == "Capturar incidencia":
     with col1:
         dt_in = st.date_input("Fecha", value=date.today())
         employee = st.text_input("Nombre del empleado")
-        plant_list = get_plants(conn)
-        plant = st.selectbox("zona", options=plant_list)
+        plant = st.selectbox("zona", options=plants)
     with col2:
         inc_type = st.selectbox("Tipo de incidencia", options=st.session_state.inc_types + ["VACACIONES"])
         notes = st.text_area("Observaciones", placeholder="Opcional")
@@ -394,14 +563,14 @@ if section == "Capturar incidencia":
 
     st.divider()
     st.subheader("Últimas capturas")
-    recent_df = read_incidents_df(conn)[:50]
+    recent_df = read_incidents_df_cached(_db_ver(), limit=50)
     if recent_df.empty:
         st.info("Aún no hay incidencias capturadas.")
     else:
         st.dataframe(recent_df, use_container_width=True)
 
 elif section == "Matriz semanal":
-    from st_aggrid import AgGrid, GridOptionsBuilder, JsCode, GridUpdateMode
+    from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
 
     st.header("📅 Matriz semanal (semana actual)")
 
@@ -411,8 +580,9 @@ elif section == "Matriz semanal":
     col_labels = [d.strftime("%a %d-%b") for d in days]   # visibles
     day_key = [d.isoformat() for d in days]               # para guardar
 
-    company = st.selectbox("Empresa", ["TODAS"] + get_companies(conn))
-    zona = st.selectbox("Zona", ["TODAS"] + get_zonas(conn))
+    zonas, companies, _ = _employee_facets(_db_ver())
+    company = st.selectbox("Empresa", ["TODAS"] + companies)
+    zona = st.selectbox("Zona", ["TODAS"] + zonas)
     emps_df = get_employees_df(conn,
                                None if zona=="TODAS" else zona,
                                None if company=="TODAS" else company)
@@ -422,37 +592,34 @@ elif section == "Matriz semanal":
 
     # Base
     grid = pd.DataFrame({"Empleado": emps_df["name"].tolist()})
-    for lab in col_labels:
-        grid[lab] = "—"
 
-    # Prellenar con incidencias de la semana
+    # Prellenar con incidencias de la semana (pivot: empleado x día)
     dfw = pd.read_sql_query("""
         SELECT employee, dt, inc_type
         FROM incidences
-        WHERE DATE(dt) BETWEEN DATE(?) AND DATE(?)
-    """, conn, params=(days[0].isoformat(), days[-1].isoformat()))
+        WHERE dt_ord BETWEEN ? AND ?
+    """, conn, params=(days[0].toordinal(), days[-1].toordinal()))
+    iso_to_label = dict(zip(day_key, col_labels))
+    dfw = dfw[dfw["dt"].str[:10].isin(iso_to_label)]
     if not dfw.empty:
-        dfw["col"] = pd.to_datetime(dfw["dt"]).dt.strftime("%a %d-%b")
-        last = dfw.groupby(["employee", "col"])["inc_type"].last().reset_index()
-        for _, r in last.iterrows():
-            if r["employee"] in grid["Empleado"].values and r["col"] in col_labels:
-                grid.loc[grid["Empleado"] == r["employee"], r["col"]] = r["inc_type"]
+        dfw = dfw.assign(col=pd.Categorical(dfw["dt"].str[:10].map(iso_to_label),
+                                            categories=col_labels))
+        grid_pv = dfw.pivot_table(index="employee", columns="col", values="inc_type",
+                                  aggfunc="last", observed=False)
+        grid = grid.merge(grid_pv, left_on="Empleado", right_index=True, how="left")
+    grid = grid.reindex(columns=["Empleado"] + col_labels).fillna("—")
 
     # Editor con select + colores por celda
     options = ["—"] + st.session_state.inc_types + ["VACACIONES"]
 
-    # cellStyle en JS (pone color según valor)
-    cell_style_js = JsCode("""
-      function(params) {
-        const v = (params.value || "").toUpperCase();
-        const colors = {
-          "FALTA":"%s","RETARDO":"%s","PERMISO":"%s","INCAPACIDAD":"%s","VACACIONES":"%s","OTRO":"%s","—":"white","": "white"
-        };
-        const bg = colors[v] || "white";
-        return { 'backgroundColor': bg, 'textTransform': 'uppercase' };
-      }
-    """ % (INC_COLOR["FALTA"], INC_COLOR["RETARDO"], INC_COLOR["PERMISO"],
-           INC_COLOR["INCAPACIDAD"], INC_COLOR["VACACIONES"], INC_COLOR["OTRO"]))
+    # Colores por clase CSS (cellClassRules) en lugar de una función JS por celda
+    inc_css = {".inc-cell": {"text-transform": "uppercase"}}
+    inc_rules = {}
+    for k, color in INC_COLOR.items():
+        if k == "—":
+            continue
+        inc_css[f".ag-cell.inc-{k}"] = {"background-color": f"{color} !important"}
+        inc_rules[f"inc-{k}"] = f"x === '{k}'"
 
     gob = GridOptionsBuilder.from_dataframe(grid)
     gob.configure_column("Empleado", editable=False, pinned="left")
@@ -463,7 +630,8 @@ elif section == "Matriz semanal":
             editable=True,
             cellEditor="agSelectCellEditor",
             cellEditorParams={"values": options},
-            cellStyle=cell_style_js
+            cellClass="inc-cell",
+            cellClassRules=inc_rules
         )
 
     # Opciones generales
@@ -475,20 +643,21 @@ elif section == "Matriz semanal":
         gridOptions=grid_options,
         update_mode=GridUpdateMode.VALUE_CHANGED,
         fit_columns_on_grid_load=True,
-        allow_unsafe_jscode=True,
+        custom_css=inc_css,
         height=550
     )
 
     if st.button("💾 Guardar cambios de la semana", type="primary", use_container_width=True):
         edited = grid_resp["data"]
-        total = 0
-        for _, row in edited.iterrows():
-            emp = row["Empleado"]
-            for lab, iso in zip(col_labels, day_key):
-                val = str(row[lab]).strip().upper()
-                replace_incidence_day(conn, iso, emp, val if val != "—" else "")
-                if val and val != "—":
-                    total += 1
+        # Formato largo (empleado, día, valor) sin recorrer filas en Python
+        long = edited.melt(id_vars="Empleado", value_vars=col_labels,
+                           var_name="col", value_name="val")
+        vals = long["val"].fillna("—").astype(str).str.strip().str.upper()
+        cells = list(zip(long["col"].map(dict(zip(col_labels, day_key))),
+                         long["Empleado"],
+                         vals.where(vals != "—", "")))
+        total = replace_incidences_bulk(conn, cells,
+                                        dict(zip(emps_df["name"], emps_df["plant"])))
         st.success(f"Cambios guardados. Incidencias registradas/actualizadas: {total}.")
         st.rerun()
 
@@ -501,38 +670,36 @@ elif section == "Consolidado / Exportar":
             st.warning("Ingresa el PIN para ver el consolidado.")
             st.stop()
 
+    zonas, companies, _ = _employee_facets(_db_ver())
     c1, c2, c3, c4 = st.columns(4)
     with c1:
         start_dt = st.date_input("Desde", value=date.today().replace(day=1))
     with c2:
         end_dt = st.date_input("Hasta", value=date.today())
     with c3:
-        company = st.selectbox("Empresa", ["TODAS"] + get_companies(conn))
+        company = st.selectbox("Empresa", ["TODAS"] + companies)
     with c4:
-        plant_filter = st.selectbox("zona", options=["TODAS"] + get_zonas(conn))
+        plant_filter = st.selectbox("zona", options=["TODAS"] + zonas)
 
-    df = read_incidents_df(conn, start_dt.isoformat(), end_dt.isoformat(), plant_filter, company)
+    excel_key = (_db_ver(), start_dt.isoformat(), end_dt.isoformat(), plant_filter, company)
+    df, summary = read_consolidado_cached(*excel_key)
     st.dataframe(df, use_container_width=True, height=420)
 
     if not df.empty:
-        summary = (df
-                   .groupby(["company","plant","inc_type"], as_index=False)
-                   .agg(Incidencias=("inc_type", "count")))
         st.subheader("Resumen por Empresa, Planta y Tipo")
         st.dataframe(summary, use_container_width=True)
 
-        excel_bytes = to_excel_bytes(
-            df.rename(columns={"dt": "Fecha", "employee": "Empleado", "plant": "Planta",
-                               "inc_type": "Tipo", "notes": "Observaciones", "company":"Empresa"}),
-            summary.rename(columns={"company":"Empresa", "plant": "Planta", "inc_type": "Tipo"})
-        )
-        st.download_button(
-            "⬇️ Descargar Excel (Datos + Resumen)",
-            data=excel_bytes,
-            file_name=f"incidencias_consolidado_{date.today().isoformat()}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True
-        )
+        # El Excel solo se genera cuando se pide (y para los mismos filtros sale del caché)
+        if st.button("📄 Preparar Excel", use_container_width=True):
+            st.session_state["excel_key"] = excel_key
+        if st.session_state.get("excel_key") == excel_key:
+            st.download_button(
+                "⬇️ Descargar Excel (Datos + Resumen)",
+                data=consolidado_excel_bytes(*excel_key),
+                file_name=f"incidencias_consolidado_{date.today().isoformat()}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                use_container_width=True
+            )
     else:
         st.info("No hay datos en el rango seleccionado.")
 
@@ -546,7 +713,7 @@ elif section == "Catálogo de Empleados":
     st.dataframe(df, use_container_width=True, height=400)
     
     st.subheader("Editar empleado")
-    sel = st.selectbox("Selecciona empleado", options=get_employees(conn))
+    sel = st.selectbox("Selecciona empleado", options=_employee_facets(_db_ver())[2])
     if sel:
         info = get_employee_info(conn, sel)
         c1,c2,c3 = st.columns(3)
@@ -575,7 +742,7 @@ elif section == "Catálogo de Empleados":
     c1,c2,c3,c4,c5,c6 = st.columns(6)
     with c1: n = st.text_input("Nombre (completo)")
     with c2: comp = st.text_input("Empresa (opcional)")
-    with c3: p = st.selectbox("Planta", options=get_plants(conn))
+    with c3: p = st.selectbox("Planta", options=plants)
     with c4: h = st.date_input("Ingreso", value=date(2024,1,1))
     with c5: dpy = st.number_input("Días/año", value=12, min_value=1, step=1)
     with c6: rd = st.selectbox("Descanso", options=["","LUN","MAR","MIE","JUE","VIE","SAB","DOM"])
@@ -599,16 +766,14 @@ elif section == "Catálogo de Empleados":
         if not need.issubset({c.lower() for c in dfu.columns}):
             st.error("El CSV debe tener al menos: name, plant, hire_date, days_per_year")
         else:
-            rows=[]
-            for _,r in dfu.iterrows():
-                rows.append({
-                    "name": str(r["name"]).upper().strip(),
-                    "plant": str(r["plant"]).upper().strip(),
-                    "hire_date": str(r["hire_date"])[:10],
-                    "days_per_year": int(r["days_per_year"]),
-                    "rest_day": (str(r.get("rest_day","")).upper().strip() or None),
-                    "company": (str(r.get("company","")).upper().strip() or None)
-                })
+            rows = pd.DataFrame({
+                "name": dfu["name"].astype(str).str.upper().str.strip(),
+                "plant": dfu["plant"].astype(str).str.upper().str.strip(),
+                "hire_date": dfu["hire_date"].astype(str).str[:10],
+                "days_per_year": dfu["days_per_year"].astype(int),
+                "rest_day": _upper_or_none(dfu, "rest_day"),
+                "company": _upper_or_none(dfu, "company"),
+            }).to_dict(orient="records")
             if st.button("Cargar CSV"):
                 seed_employees(conn, rows)
                 st.success(f"{len(rows)} empleados cargados/actualizados.")
@@ -633,8 +798,7 @@ elif section == "Catálogo de Empleados":
 elif section == "Catálogo de Plantas":
     st.header("🏷️ Catálogo de Plantas")
     st.write("Agrega o corrige nombres. Evita duplicados y mayúsculas/minúsculas inconsistentes.")
-    existing = get_plants(conn)
-    st.write("Plantas actuales:", ", ".join(existing) if existing else "—")
+    st.write("Plantas actuales:", ", ".join(plants) if plants else "—")
 
     new_name = st.text_input("Nueva planta", placeholder="Ej. GAS LUX, JEREZ, etc.")
     if st.button("Agregar planta"):
@@ -651,7 +815,7 @@ elif section == "Vacaciones":
     tab1, tab2 = st.tabs(["Resumen anual", "Por mes"])
 
     with tab1:
-        dfv = vacation_status_for_all(conn)
+        dfv = vacation_status_for_all_cached(_db_ver())
         if dfv.empty:
             st.info("Sin empleados cargados.")
         else:
@@ -669,7 +833,7 @@ elif section == "Vacaciones":
     with tab2:
         st.write("Filtra empleados según el **mes de aniversario de ingreso** y su saldo disponible.")
         mes = st.selectbox("Mes", list(range(1,13)), format_func=lambda m: date(2000, m, 1).strftime("%B").capitalize())
-        dfv = vacation_status_for_all(conn)
+        dfv = vacation_status_for_all_cached(_db_ver())
         if dfv.empty:
             st.info("Sin empleados cargados.")
         else:
@@ -693,16 +857,14 @@ elif section == "Gráficos":
     st.header("📊 Gráficos")
     since = st.date_input("Desde", value=date.today().replace(month=1, day=1))
     until = st.date_input("Hasta", value=date.today())
-    company = st.selectbox("Empresa", ["TODAS"] + get_companies(conn), key="g_company")
-    plant = st.selectbox("Planta", ["TODAS"] + get_plants(conn), key="g_plant")
-    dfg = read_incidents_df(conn, since.isoformat(), until.isoformat(), plant, company)
+    company = st.selectbox("Empresa", ["TODAS"] + _employee_facets(_db_ver())[1], key="g_company")
+    plant = st.selectbox("Planta", ["TODAS"] + plants, key="g_plant")
+    dfg = read_incidents_df_cached(_db_ver(), since.isoformat(), until.isoformat(), plant, company)
     if dfg.empty:
         st.info("No hay datos.")
     else:
-        dfg["count"] = 1
-        top = (dfg[dfg["inc_type"].str.upper()=="FALTA"]
-               .groupby("employee")["count"].sum()
-               .sort_values(ascending=False).head(10))
+        top = (dfg.loc[dfg["inc_type"].str.upper()=="FALTA", "employee"]
+               .value_counts().head(10))
         st.subheader("Top 10 FALTAS")
         st.bar_chart(top)
 
@@ -710,5 +872,7 @@ elif section == "Configuración":
     st.header("⚙️ Configuración")
     st.code(f"DB_PATH = '{DB_PATH}'", language="python")
     st.write("Para proteger el consolidado con un PIN, crea un archivo `.env` y define `ADMIN_PIN`.")
-    st.write("**Respaldo de datos**: copia el archivo `incidencias.db`.")
+    st.write("**Respaldo de datos**: la base usa WAL; lo más reciente puede estar aún en "
+             "`incidencias.db-wal`. Respalda con el comando de SQLite (no copies solo el `.db`):")
+    st.code(f'sqlite3 {DB_PATH} ".backup respaldo.db"', language="bash")
     st.write("**Carga inicial de plantas**: edita `seeds/plants.json` antes del primer arranque.")